@@ -1,5 +1,6 @@
 import sys
 import os
+import time
 
 from src.wix_api import Products, Orders, Inventory
 from src.utils import sku_replace, sku_frames_to_clear, setup_logger, send_email
@@ -38,7 +39,13 @@ class StockManager:
             )
 
     def prep_inventory_email(
-        self, orderId, product_details, name_details, status, update_status_idx=None
+        self,
+        orderId,
+        product_details,
+        name_details,
+        status,
+        update_status_idx=None,
+        unconfirmed_idx=None,
     ):
         """
         Prepares the email to be sent for the inventory update status.
@@ -51,20 +58,48 @@ class StockManager:
             message += f"<p>{product[0]} | {product[-1]}: -{quantity}</p>"
         if update_status_idx is not None:
             message += f"<p><font color='red'>Failed to update inventory for the following products:</font></p>"
-            for idx in update_status_idx:
-                product_name = product_details[idx][0][0]
-                choices = '-'.join(product_details[idx][0][-1].values()) if product_details[idx][0][-1] is not None else None
-                quantity = product_details[idx][1]
-                if choices is None:
-                    message += f"<p>{product_name}: {quantity}</p>"
-                else:
-                    message += f"<p>{product_name} | {choices}: {quantity}</p>"
-            message += "<p>Signed by The Naos bot</p>"        
+            message += self._product_lines(product_details, update_status_idx)
+        if unconfirmed_idx is not None:
+            message += f"<p><font color='red'>Could not confirm the inventory update for the following products, please check their stock manually:</font></p>"
+            message += self._product_lines(product_details, unconfirmed_idx)
+        if (update_status_idx is not None) | (unconfirmed_idx is not None):
+            message += "<p>Signed by The Naos bot</p>"
         subject = (
             f"[{status}] Inventory Update Status - {name_details[0]} {name_details[1]}"
         )
         return message, subject
 
+    def prep_coalesced_email(self, orderId, product_details, name_details, coalescer):
+        """
+        Prepares the status email of an order whose decrements went through a DecrementCoalescer.
+        """
+        update_status_idx = coalescer.failed_indices(orderId)
+        unconfirmed_idx = coalescer.unconfirmed_indices(orderId)
+        if (len(update_status_idx) == 0) & (len(unconfirmed_idx) == 0):
+            return self.prep_inventory_email(
+                orderId, product_details, name_details, status="SUCCESS"
+            )
+        return self.prep_inventory_email(
+            orderId,
+            product_details,
+            name_details,
+            status="FAIL",
+            update_status_idx=update_status_idx or None,
+            unconfirmed_idx=unconfirmed_idx or None,
+        )
+
+    def _product_lines(self, product_details, indices):
+        message = ""
+        for idx in indices:
+            product_name = product_details[idx][0][0]
+            choices = '-'.join(product_details[idx][0][-1].values()) if product_details[idx][0][-1] is not None else None
+            quantity = product_details[idx][1]
+            if choices is None:
+                message += f"<p>{product_name}: {quantity}</p>"
+            else:
+                message += f"<p>{product_name} | {choices}: {quantity}</p>"
+        return message
+
 
 class SKUHandler(StockManager):
     def __init__(self):
@@ -109,67 +144,263 @@ class SKUHandler(StockManager):
     def process_sku(self, sku):
         if sku in self.sku_mapping:
             return self.sku_mapping[sku]
-        elif sku in self.sku_replace.keys():
+        elif (sku in self.sku_replace.keys()) & (self.sku_replace.get(sku) in self.sku_mapping):
             return self.sku_mapping[self.sku_replace[sku]]
         else:
             self.logger.error(f"Sku {sku} not found in  sku mapping")
 
 
+class DecrementCoalescer:
+    """
+    Collects inventory decrements across many orders and flushes them as combined
+    decrement requests per (productId, variantId), to keep API calls low during bursts.
+    Success or failure of each item is attributed back to the order it came from.
+    """
+
+    def __init__(
+        self,
+        inventory,
+        logger,
+        max_items=50,
+        max_wait=5.0,
+        max_rate_limit_retries=2,
+        max_backoff=30.0,
+    ):
+        """
+        :param inventory: The Inventory API object used to send the decrements.
+        :param logger: The logger to report to.
+        :param max_items: Flush once this many distinct products/variants are pending.
+        :param max_wait: Flush once the oldest pending decrement is this many seconds old.
+            There is no timer, this is checked on add() and poll().
+        :param max_rate_limit_retries: How often a rate limited (429) request is resent.
+        :param max_backoff: Upper bound in seconds on the wait before resending a rate limited request.
+        """
+        self.inv = inventory
+        self.logger = logger
+        self.max_items = max_items
+        self.max_wait = max_wait
+        self.max_rate_limit_retries = max_rate_limit_retries
+        self.max_backoff = max_backoff
+        self.pending = {}
+        self.first_added = None
+        self.failed = {}
+        self.unconfirmed = {}
+
+    def add(self, orderId, idx, product, quantity):
+        """
+        Queue a decrement for the product at position idx of the order's product details.
+        """
+        key = (product[1], product[2])
+        self.pending.setdefault(key, []).append((orderId, idx, product, quantity))
+        if self.first_added is None:
+            self.first_added = time.monotonic()
+        if len(self.pending) >= self.max_items:
+            self.flush()
+        else:
+            self.poll()
+
+    def poll(self):
+        """
+        Flush if the oldest pending decrement is older than max_wait.
+        Call this between slow steps so a pending batch does not wait for the next add().
+        """
+        if (self.first_added is not None) and (
+            time.monotonic() - self.first_added >= self.max_wait
+        ):
+            self.flush()
+
+    def flush(self):
+        """
+        Send all pending decrements, combined per (productId, variantId).
+        Only when Wix explicitly rejects a request (4xx) is it split up and retried,
+        down to single order items, so that failures are attributed to the right orders.
+        If the outcome is unknown (no response or 5xx) nothing is resent, as the
+        decrement may already have been applied, and the items are marked unconfirmed.
+        Rate limited requests (429) were not applied and are resent as is after a back-off.
+        """
+        if not self.pending:
+            return
+        keys = list(self.pending.keys())
+        outcome = self._decrement(
+            [(productid, variantid, self._total(self.pending[(productid, variantid)]))
+             for productid, variantid in keys]
+        )
+        if outcome == "success":
+            for key in keys:
+                self._log_success(self.pending[key])
+        elif outcome == "unknown":
+            for key in keys:
+                self._log_unconfirmed(self.pending[key])
+        elif len(keys) == 1:
+            self._retry_entries(keys[0], self.pending[keys[0]])
+        else:
+            self.logger.warning(
+                f"Batch decrement of {len(keys)} items was rejected, retrying per product"
+            )
+            for key in keys:
+                entries = self.pending[key]
+                outcome = self._decrement([(key[0], key[1], self._total(entries))])
+                if outcome == "success":
+                    self._log_success(entries)
+                elif outcome == "unknown":
+                    self._log_unconfirmed(entries)
+                else:
+                    self._retry_entries(key, entries)
+        self.pending = {}
+        self.first_added = None
+
+    def failed_indices(self, orderId):
+        """
+        Return the indices of the order's product details that failed to update.
+        """
+        return sorted(self.failed.get(orderId, []))
+
+    def unconfirmed_indices(self, orderId):
+        """
+        Return the indices of the order's product details whose update could not be confirmed.
+        """
+        return sorted(self.unconfirmed.get(orderId, []))
+
+    def _decrement(self, decrements):
+        """
+        Send the decrements and classify the outcome as "success", "rejected" or "unknown".
+        A rate limited request is resent after the Retry-After delay, and counts as
+        "unknown" if it is still rate limited, so it is never split up or marked as failed.
+        """
+        for attempt in range(self.max_rate_limit_retries + 1):
+            result = self.inv.decrease_inventory_batch(decrements)
+            if result is None or result[1] is None:
+                return "unknown"
+            status_code = result[1].status_code
+            if status_code != 429:
+                break
+            if attempt < self.max_rate_limit_retries:
+                delay = self._retry_after(result[1])
+                self.logger.warning(
+                    f"Decrement of {len(decrements)} items was rate limited, retrying in {delay}s"
+                )
+                time.sleep(delay)
+        else:
+            self.logger.error(
+                f"Decrement of {len(decrements)} items still rate limited after {self.max_rate_limit_retries} retries"
+            )
+            return "unknown"
+        if status_code == 200:
+            return "success"
+        if 400 <= status_code < 500:
+            return "rejected"
+        return "unknown"
+
+    def _retry_after(self, response):
+        try:
+            delay = float(response.headers.get("Retry-After", 1.0))
+        except (TypeError, ValueError):
+            # Retry-After may also be an HTTP date, fall back to a short wait
+            delay = 1.0
+        return min(max(delay, 0.0), self.max_backoff)
+
+    def _retry_entries(self, key, entries):
+        """
+        Retry the entries of a rejected product one by one, so only the orders
+        that could not be served are marked as failed.
+        """
+        if len(entries) == 1:
+            self._log_failure(entries)
+            return
+        for entry in entries:
+            outcome = self._decrement([(key[0], key[1], entry[3])])
+            if outcome == "success":
+                self._log_success([entry])
+            elif outcome == "unknown":
+                self._log_unconfirmed([entry])
+            else:
+                self._log_failure([entry])
+
+    def _log_success(self, entries):
+        for orderId, _, product, _ in entries:
+            self.logger.info(
+                f"Successfully updated inventory for product {product[0]} | {self._choices(product)} (order {orderId})"
+            )
+
+    def _log_failure(self, entries):
+        for orderId, idx, product, _ in entries:
+            self.failed.setdefault(orderId, []).append(idx)
+            self.logger.error(
+                f"Failed to update inventory for product {product[0]} | {self._choices(product)} (order {orderId})"
+            )
+
+    def _log_unconfirmed(self, entries):
+        for orderId, idx, product, _ in entries:
+            self.unconfirmed.setdefault(orderId, []).append(idx)
+            self.logger.error(
+                f"Could not confirm inventory update for product {product[0]} | {self._choices(product)} (order {orderId}), check stock manually"
+            )
+
+    @staticmethod
+    def _total(entries):
+        return sum(entry[3] for entry in entries)
+
+    @staticmethod
+    def _choices(product):
+        return "-".join(product[3].values()) if product[3] is not None else None
+
+
 def main():
     sku_handler = SKUHandler()
     sm = StockManager()
     inv = Inventory()
-    order_id = input("Enter order id: ")
-    name_details, order_stock_details = sm.get_order_details(order_id)
-    if order_stock_details is None:
-        sm.logger.error(f"failed to get details for order {order_id}")
-    product_details = []
-    for concat_sku, quantity in order_stock_details:
-        sku_parts = concat_sku.split("-")
-        for sku in sku_parts:
-            product = sku_handler.process_sku(sku)
-            if product is None:
-                sm.logger.error(f"failed to get product details for sku {sku}")
+    coalescer = DecrementCoalescer(
+        inv,
+        sm.logger,
+        max_items=int(os.getenv("DECREMENT_WINDOW_SIZE", 50)),
+        max_wait=float(os.getenv("DECREMENT_WINDOW_SECONDS", 5.0)),
+    )
+    order_ids = [
+        order_id.strip()
+        for order_id in input("Enter order id(s), comma separated: ").split(",")
+        if order_id.strip() != ""
+    ]
+    if len(set(order_ids)) != len(order_ids):
+        sm.logger.warning("Duplicate order ids were entered, each order is only processed once")
+    # dedupe while keeping the order, so no order is decremented twice
+    order_ids = list(dict.fromkeys(order_ids))
+    orders = {}
+    for order_id in order_ids:
+        coalescer.poll()
+        try:
+            order_details = sm.get_order_details(order_id)
+            if order_details is None:
+                sm.logger.error(f"failed to get details for order {order_id}")
                 continue
-            if sku in sku_frames_to_clear.keys(): # adds spare lens if needed
-                clear_lens = sku_handler.process_sku(sku_frames_to_clear[sku])
-                product_details.append((clear_lens, quantity))
-            product_details.append((product, quantity))
-
-    update_status_idx = []
-    i = 0
-    for product, quantity in product_details:
-        product_name, productid, variantid, choices = product[0], product[1], product[2], "-".join(product[3].values()) if product[3] is not None else None
-        _, response = inv.decrease_inventory(productid, variantid, quantity)
-        if response.status_code == 200:
-            sm.logger.info(
-                f"Successfully updated inventory for product {product_name} | {choices}"
-            )
-        else:
-            update_status_idx.append(i)
-            i += 1
-            logging.error(
-                f"Failed to update inventory for product {product_name} | {choices} with status code {response.status_code}"
-            )
-    if len(update_status_idx) == 0:
-        msg, sub = sm.prep_inventory_email(
-            order_id, product_details, name_details, status="SUCCESS"
-        )
-        send_email(
-            msg,
-            sub,
-            "info@naos-optics.com",  # public facing email
-            "info@naos-optics.com",  # public facing email
-            sm.sg_api_key,
-            sm.logger,
-        )
-    else:
-        msg, sub = sm.prep_inventory_email(
-            order_id,
-            product_details,
-            name_details,
-            status="FAIL",
-            update_status_idx=update_status_idx,
+            name_details, order_stock_details = order_details
+            product_details = []
+            for concat_sku, quantity in order_stock_details:
+                sku_parts = concat_sku.split("-")
+                for sku in sku_parts:
+                    product = sku_handler.process_sku(sku)
+                    if product is None:
+                        sm.logger.error(f"failed to get product details for sku {sku}")
+                        continue
+                    if sku in sku_frames_to_clear.keys(): # adds spare lens if needed
+                        clear_lens = sku_handler.process_sku(sku_frames_to_clear[sku])
+                        if clear_lens is None:
+                            sm.logger.error(
+                                f"failed to get clear lens details for sku {sku_frames_to_clear[sku]}"
+                            )
+                        else:
+                            product_details.append((clear_lens, quantity))
+                    product_details.append((product, quantity))
+        except Exception as e:
+            sm.logger.error(f"failed to process order {order_id}: {str(e)}")
+            continue
+        for idx, (product, quantity) in enumerate(product_details):
+            coalescer.add(order_id, idx, product, quantity)
+        orders[order_id] = (name_details, product_details)
+    coalescer.flush()
+
+    for order_id, (name_details, product_details) in orders.items():
+        msg, sub = sm.prep_coalesced_email(
+            order_id, product_details, name_details, coalescer
         )
         send_email(
             msg,
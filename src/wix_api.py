@@ -1,18 +1,92 @@
 import sys
 
 import os
+import time
+import threading
 import requests
 import json
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from src.utils import setup_logger
 from typing import List
 from pprint import pprint
 
 
+class CircuitOpenError(requests.RequestException):
+    """
+    Raised when the circuit breaker of an endpoint is open and no cached response is available.
+    """
+
+
+class CircuitBreaker:
+    """
+    Simple circuit breaker: opens after a number of consecutive failures and stays open
+    for a cooldown period, after which a single trial request is let through.
+    """
+
+    def __init__(self, failure_threshold=3, cooldown=30.0):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self.lock = threading.Lock()
+
+    def allow_request(self):
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if time.monotonic() - self.opened_at >= self.cooldown:
+                # half-open: let one trial request through, re-open if it fails
+                self.opened_at = time.monotonic()
+                return True
+            return False
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+
+
 class WixAPI:
     """
     WixAPI class that handles communication with the Wix API.
+    Read-only calls go through _read_request, which adds per-endpoint timeouts,
+    hedged requests and a circuit breaker serving stale cached responses.
+    State is kept on the class so it is shared by all API objects in a run.
     """
 
+    # per-endpoint timeouts in seconds for the whole request, falls back to default_timeout
+    timeouts = {
+        "get_order": 10.0,
+        "get_paid_orders": 10.0,
+        "get_product": 10.0,
+        "query_products": 30.0,
+        "get_inventory_variants": 10.0,
+        "decrease_inventory": 30.0,
+    }
+    default_timeout = 10.0
+    # send a duplicate request once a call is slower than this latency percentile,
+    # or than hedge_default_delay while fewer than hedge_min_samples calls were timed
+    hedge_percentile = 0.95
+    hedge_min_samples = 20
+    hedge_min_delay = 0.1
+    hedge_default_delay = 2.0
+    # never wait longer than this fraction of the timeout before hedging, so hedging
+    # stays on when many calls time out and push the percentile up to the timeout
+    hedge_max_timeout_fraction = 0.5
+    latency_window = 200
+    _latencies = {}
+    _breakers = {}
+    _cache = {}
+    _state_lock = threading.Lock()
+    _executor = ThreadPoolExecutor(max_workers=8)
+
     def __init__(self):
         """
         Initialize the WixAPI object with the API key and site id from the environment variables
@@ -49,6 +123,111 @@ class WixAPI:
         adapted_headers = {k: value for k, value in self.headers.items() if k != key}
         return adapted_headers
 
+    def _hedge_delay(self, name, timeout):
+        """
+        Return the delay after which a hedged request is sent: the latency percentile
+        of the endpoint, or hedge_default_delay if not enough samples were collected yet,
+        capped at a fraction of the timeout.
+        """
+        with self._state_lock:
+            latencies = sorted(self._latencies.get(name, []))
+        if len(latencies) < self.hedge_min_samples:
+            delay = self.hedge_default_delay
+        else:
+            delay = latencies[
+                min(int(len(latencies) * self.hedge_percentile), len(latencies) - 1)
+            ]
+        return min(max(delay, self.hedge_min_delay), timeout * self.hedge_max_timeout_fraction)
+
+    def _timed_request(self, name, method, endpoint, headers, data, timeout):
+        start = time.monotonic()
+        try:
+            return requests.request(
+                method, endpoint, headers=headers, data=data, timeout=timeout
+            )
+        finally:
+            # failed and timed out calls count too, otherwise the percentile is too optimistic
+            with self._state_lock:
+                self._latencies.setdefault(name, deque(maxlen=self.latency_window)).append(
+                    time.monotonic() - start
+                )
+
+    def _read_request(self, name, method, endpoint, headers, data=None):
+        """
+        Send an idempotent read request with a timeout, hedging and a circuit breaker.
+        While the circuit is open the last successful response for the same request is served.
+        :param name: The endpoint name, used for timeouts, latency stats and the breaker.
+        :param method: The HTTP method, e.g. "GET".
+        :param endpoint: The URL to send the request to.
+        :param headers: The headers to send.
+        :param data: The serialized request body, if any.
+        """
+        with self._state_lock:
+            breaker = self._breakers.setdefault(name, CircuitBreaker())
+        cache_key = (method, endpoint, data)
+        if not breaker.allow_request():
+            cached = self._cache.get(cache_key)
+            if cached is None:
+                raise CircuitOpenError(f"Circuit open for {name} and no cached response")
+            self.logger.warning(f"Circuit open for {name}, serving stale cached response")
+            return cached
+
+        timeout = self.timeouts.get(name, self.default_timeout)
+        # requests applies its timeout per connect/read, so also bound the request as a whole
+        deadline = time.monotonic() + timeout
+        hedge_delay = self._hedge_delay(name, timeout)
+        futures = [
+            self._executor.submit(
+                self._timed_request, name, method, endpoint, headers, data, timeout
+            )
+        ]
+        done, _ = wait(futures, timeout=hedge_delay)
+        if not done:
+            self.logger.info(f"{name} slower than {hedge_delay:.2f}s, sending hedged request")
+            futures.append(
+                self._executor.submit(
+                    self._timed_request, name, method, endpoint, headers, data, timeout
+                )
+            )
+        # return the first successful response, or the last error if all failed
+        error = None
+        pending = set(futures)
+        while pending:
+            done, pending = wait(
+                pending,
+                timeout=max(deadline - time.monotonic(), 0),
+                return_when=FIRST_COMPLETED,
+            )
+            if not done:
+                error = requests.Timeout(f"{name} did not complete within {timeout}s")
+                break
+            for future in done:
+                try:
+                    response = future.result()
+                except requests.RequestException as e:
+                    error = e
+                    continue
+                # rate limiting means the API is degraded too, so it must not reset the breaker
+                if (response.status_code >= 500) | (response.status_code == 429):
+                    error = requests.HTTPError(
+                        f"{name} failed with status code {response.status_code}",
+                        response=response,
+                    )
+                    continue
+                breaker.record_success()
+                if response.status_code == 200:
+                    self._cache[cache_key] = response
+                return response
+
+        breaker.record_failure()
+        cached = self._cache.get(cache_key)
+        if cached is not None:
+            self.logger.warning(f"{name} failed ({error}), serving stale cached response")
+            return cached
+        if isinstance(error, requests.HTTPError):
+            return error.response
+        raise error
+
 
 class Orders(WixAPI):
     """
@@ -73,8 +252,12 @@ class Orders(WixAPI):
             }
         }
         try:
-            response = requests.post(
-                endpoint, headers=self.headers, data=json.dumps(data)
+            response = self._read_request(
+                "get_paid_orders",
+                "POST",
+                endpoint,
+                headers=self.headers,
+                data=json.dumps(data),
             )
             self.logger.info(f"Orders status code: {response.status_code}")
             return self._handle_response(response)
@@ -88,7 +271,9 @@ class Orders(WixAPI):
         """
         endpoint = f"{self.base_url_v2}orders/{orderId}"
         try:
-            response = requests.get(
+            response = self._read_request(
+                "get_order",
+                "GET",
                 endpoint,
                 headers=self.headers,
             )
@@ -121,8 +306,12 @@ class Inventory(WixAPI):
         )
 
         try:
-            response = requests.post(
-                endpoint, headers=self.headers, data=json.dumps(data)
+            response = self._read_request(
+                "get_inventory_variants",
+                "POST",
+                endpoint,
+                headers=self.headers,
+                data=json.dumps(data),
             )
             self.logger.info(
                 f"get_inventory_variants status code: {response.status_code}"
@@ -155,7 +344,10 @@ class Inventory(WixAPI):
             ] = "00000000-0000-0000-0000-000000000000"
         try:
             response = requests.post(
-                endpoint, headers=self.headers, data=json.dumps(data)
+                endpoint,
+                headers=self.headers,
+                data=json.dumps(data),
+                timeout=self.timeouts.get("decrease_inventory", self.default_timeout),
             )
             response.raise_for_status()
             self.logger.info(f"Decrease inventory status code for {productId}-{variantId}: {response.status_code}")
@@ -163,6 +355,44 @@ class Inventory(WixAPI):
         except requests.RequestException as e:
             self.logger.error(str(e))
 
+    def decrease_inventory_batch(self, decrements: List[tuple]):
+        """
+        Decrease inventory of several products/variants in a single request.
+        :param decrements: List of (productId, variantId, quantity) tuples, variantId may be None.
+        :return: (json, response), (None, response) if Wix answered with an error status,
+            or None if no response was received and the outcome is unknown.
+        """
+        endpoint = f"{self.base_url_v2}inventoryItems/decrement"
+        data = {
+            "decrementData": [
+                {
+                    "productId": productId,
+                    "variantId": variantId
+                    if variantId is not None
+                    else "00000000-0000-0000-0000-000000000000",
+                    "decrementBy": quantity,
+                }
+                for productId, variantId, quantity in decrements
+            ]
+        }
+        try:
+            response = requests.post(
+                endpoint,
+                headers=self.headers,
+                data=json.dumps(data),
+                timeout=self.timeouts.get("decrease_inventory", self.default_timeout),
+            )
+            response.raise_for_status()
+            self.logger.info(
+                f"Batch decrease inventory status code for {len(decrements)} items: {response.status_code}"
+            )
+            return self._handle_response(response), response
+        except requests.HTTPError as e:
+            self.logger.error(str(e))
+            return None, e.response
+        except requests.RequestException as e:
+            self.logger.error(str(e))
+
 
 class Products(WixAPI):
     """
@@ -177,7 +407,9 @@ class Products(WixAPI):
         endpoint = f"{self.base_url_v1}products/{productId}"
         headers = self._exclude_header_key("Content-Type")
         try:
-            response = requests.get(
+            response = self._read_request(
+                "get_product",
+                "GET",
                 endpoint,
                 headers=headers,
             )
@@ -205,8 +437,12 @@ class Products(WixAPI):
             "includeHiddenProducts": includeHiddenProducts,
         }
         try:
-            response = requests.post(
-                endpoint, headers=self.headers, data=json.dumps(data)
+            response = self._read_request(
+                "query_products",
+                "POST",
+                endpoint,
+                headers=self.headers,
+                data=json.dumps(data),
             )
             if response.json()["totalResults"] > 100:
                 self.logger.warning(
@@ -252,7 +488,10 @@ class Products(WixAPI):
         endpoint = f"{self.base_url_v1}products"
         try:
             response = requests.post(
-                endpoint, headers=self.headers, data=json.dumps(product)
+                endpoint,
+                headers=self.headers,
+                data=json.dumps(product),
+                timeout=self.timeouts.get("create_product", self.default_timeout),
             )
             self.logger.info(f"Create product status code: {response.status_code}")
             return self._handle_response(response)
@@ -271,7 +510,10 @@ class Products(WixAPI):
         endpoint = f"{self.base_url_v1}products/{productId}"
         try:
             response = requests.patch(
-                endpoint, headers=self.headers, data=json.dumps(data)
+                endpoint,
+                headers=self.headers,
+                data=json.dumps(data),
+                timeout=self.timeouts.get("update_product", self.default_timeout),
             )
             self.logger.info(f"Update product status code: {response.status_code}")
             return self._handle_response(response)
@@ -309,7 +551,10 @@ class Products(WixAPI):
         data = {"variants": [variant]}
         try:
             response = requests.patch(
-                endpoint, headers=self.headers, data=json.dumps(data)
+                endpoint,
+                headers=self.headers,
+                data=json.dumps(data),
+                timeout=self.timeouts.get("update_variant", self.default_timeout),
             )
             self.logger.info(f"Update variant status code: {response.status_code}")
             return self._handle_response(response)
@@ -0,0 +1,188 @@
+import logging
+
+import src.stock_manager as stock_manager
+from src.stock_manager import DecrementCoalescer, StockManager
+
+
+class FakeResponse:
+    def __init__(self, status_code, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+
+
+class FakeInventory:
+    """
+    Fake Inventory that keeps stock per (productId, variantId) and rejects (400)
+    any request asking for more than is in stock, unless told to fail otherwise.
+    """
+
+    def __init__(self, stock, batch_result="stock", rate_limited_calls=0):
+        self.stock = dict(stock)
+        self.batch_result = batch_result
+        self.rate_limited_calls = rate_limited_calls
+        self.calls = []
+
+    def decrease_inventory_batch(self, decrements):
+        self.calls.append(list(decrements))
+        if len(self.calls) <= self.rate_limited_calls:
+            return None, FakeResponse(429, {"Retry-After": "2"})
+        if self.batch_result != "stock":
+            return self.batch_result
+        for productId, variantId, quantity in decrements:
+            if self.stock.get((productId, variantId), 0) < quantity:
+                return None, FakeResponse(400)
+        for productId, variantId, quantity in decrements:
+            self.stock[(productId, variantId)] -= quantity
+        return {}, FakeResponse(200)
+
+
+def product(productId, variantId=None):
+    return ("name", productId, variantId, None)
+
+
+def coalescer(inventory, **kwargs):
+    kwargs.setdefault("max_items", 100)
+    kwargs.setdefault("max_wait", 100)
+    return DecrementCoalescer(inventory, logging.getLogger("test"), **kwargs)
+
+
+def test_decrements_are_combined_per_product():
+    inv = FakeInventory({("p1", "v1"): 10, ("p2", None): 10})
+    c = coalescer(inv)
+    c.add("o1", 0, product("p1", "v1"), 1)
+    c.add("o2", 0, product("p1", "v1"), 2)
+    c.add("o2", 1, product("p2"), 1)
+    c.flush()
+    assert inv.calls == [[("p1", "v1", 3), ("p2", None, 1)]]
+    assert inv.stock == {("p1", "v1"): 7, ("p2", None): 9}
+    assert c.failed_indices("o1") == [] and c.failed_indices("o2") == []
+
+
+def test_size_window_triggers_flush():
+    inv = FakeInventory({("p1", None): 10, ("p2", None): 10})
+    c = coalescer(inv, max_items=2)
+    c.add("o1", 0, product("p1"), 1)
+    assert inv.calls == []
+    c.add("o1", 1, product("p2"), 1)
+    assert len(inv.calls) == 1
+    assert c.pending == {}
+
+
+def test_time_window_triggers_flush(monkeypatch):
+    now = [0.0]
+    monkeypatch.setattr(stock_manager.time, "monotonic", lambda: now[0])
+    inv = FakeInventory({("p1", None): 10, ("p2", None): 10})
+    c = coalescer(inv, max_wait=5)
+    c.add("o1", 0, product("p1"), 1)
+    now[0] = 4.0
+    c.poll()
+    assert inv.calls == []
+    now[0] = 5.0
+    # the window is checked on poll, without waiting for the next add
+    c.poll()
+    assert inv.calls == [[("p1", None, 1)]]
+    now[0] = 6.0
+    c.add("o2", 0, product("p2"), 1)
+    assert len(inv.calls) == 1
+    now[0] = 11.0
+    c.add("o3", 0, product("p2"), 1)
+    assert inv.calls[1] == [("p2", None, 2)]
+
+
+def test_rejected_batch_only_fails_orders_that_cannot_be_served():
+    inv = FakeInventory({("p1", None): 2, ("p2", None): 10})
+    c = coalescer(inv)
+    c.add("o1", 0, product("p1"), 1)
+    c.add("o2", 0, product("p1"), 1)
+    c.add("o3", 0, product("p1"), 1)
+    c.add("o3", 1, product("p2"), 1)
+    c.flush()
+    assert c.failed_indices("o1") == []
+    assert c.failed_indices("o2") == []
+    assert c.failed_indices("o3") == [0]
+    assert inv.stock == {("p1", None): 0, ("p2", None): 9}
+
+
+def test_unknown_outcome_is_not_resent():
+    for batch_result in [None, (None, FakeResponse(503))]:
+        inv = FakeInventory({("p1", None): 10}, batch_result=batch_result)
+        c = coalescer(inv)
+        c.add("o1", 0, product("p1"), 1)
+        c.add("o2", 0, product("p1"), 1)
+        c.flush()
+        assert len(inv.calls) == 1
+        assert c.unconfirmed_indices("o1") == [0]
+        assert c.unconfirmed_indices("o2") == [0]
+        assert c.failed_indices("o1") == []
+
+
+def test_rate_limited_batch_is_resent_as_is(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(stock_manager.time, "sleep", sleeps.append)
+    stock = {(f"p{i}", None): 10 for i in range(2)}
+    inv = FakeInventory(stock, rate_limited_calls=1)
+    c = coalescer(inv)
+    for order in range(5):
+        for i in range(2):
+            c.add(f"o{order}", i, product(f"p{i}"), 1)
+    c.flush()
+    assert len(inv.calls) == 2
+    assert inv.calls[0] == inv.calls[1] == [("p0", None, 5), ("p1", None, 5)]
+    assert sleeps == [2.0]
+    for order in range(5):
+        assert c.failed_indices(f"o{order}") == []
+        assert c.unconfirmed_indices(f"o{order}") == []
+
+
+def test_rate_limited_batch_is_never_split_or_failed(monkeypatch):
+    monkeypatch.setattr(stock_manager.time, "sleep", lambda delay: None)
+    stock = {(f"p{i}", None): 10 for i in range(2)}
+    inv = FakeInventory(stock, rate_limited_calls=100)
+    c = coalescer(inv, max_rate_limit_retries=2)
+    for order in range(5):
+        for i in range(2):
+            c.add(f"o{order}", i, product(f"p{i}"), 1)
+    c.flush()
+    assert len(inv.calls) == 3
+    for order in range(5):
+        assert c.failed_indices(f"o{order}") == []
+        assert c.unconfirmed_indices(f"o{order}") == [0, 1]
+
+
+def test_status_emails_are_attributed_per_order(monkeypatch):
+    inv = FakeInventory({("p1", None): 1, ("p2", "v2"): 10})
+    c = coalescer(inv)
+    orders = {
+        "o1": [(("Frame", "p1", None, None), 1), (("Lens", "p2", "v2", {"Color": "Blue"}), 1)],
+        "o2": [(("Frame", "p1", None, None), 1)],
+        "o3": [(("Lens", "p2", "v2", {"Color": "Blue"}), 2)],
+    }
+    for orderId, product_details in orders.items():
+        for idx, (prod, quantity) in enumerate(product_details):
+            c.add(orderId, idx, prod, quantity)
+    c.flush()
+    sm = StockManager.__new__(StockManager)
+    emails = {
+        orderId: sm.prep_coalesced_email(orderId, product_details, ("Jane", "Doe"), c)
+        for orderId, product_details in orders.items()
+    }
+    assert emails["o1"][1].startswith("[SUCCESS]")
+    assert emails["o3"][1].startswith("[SUCCESS]")
+    msg, subject = emails["o2"]
+    assert subject.startswith("[FAIL]")
+    failed_section = msg.split("Failed to update inventory")[1]
+    assert "<p>Frame: 1</p>" in failed_section
+
+    # a batch without a response is unconfirmed for every order in it
+    inv = FakeInventory({}, batch_result=None)
+    c = coalescer(inv)
+    for orderId, product_details in orders.items():
+        for idx, (prod, quantity) in enumerate(product_details):
+            c.add(orderId, idx, prod, quantity)
+    c.flush()
+    msg, subject = sm.prep_coalesced_email("o1", orders["o1"], ("Jane", "Doe"), c)
+    assert subject.startswith("[FAIL]")
+    assert "Failed to update inventory" not in msg
+    unconfirmed_section = msg.split("check their stock manually")[1]
+    assert "<p>Frame: 1</p>" in unconfirmed_section
+    assert "<p>Lens | Blue: 1</p>" in unconfirmed_section
@@ -0,0 +1,169 @@
+import json
+import time
+
+import pytest
+import requests
+
+import src.wix_api as wix_api
+from src.wix_api import CircuitBreaker, CircuitOpenError, Inventory, Orders, WixAPI
+
+
+class FakeResponse:
+    def __init__(self, status_code=200, body=None):
+        self.status_code = status_code
+        self.body = body if body is not None else {"ok": True}
+
+    def json(self):
+        return self.body
+
+
+@pytest.fixture
+def orders(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "logs").mkdir()
+    monkeypatch.setenv("WIX_API_KEY", "key")
+    monkeypatch.setenv("WIX_SITE_ID", "site")
+    # fresh shared state for every test
+    monkeypatch.setattr(WixAPI, "_latencies", {})
+    monkeypatch.setattr(WixAPI, "_breakers", {})
+    monkeypatch.setattr(WixAPI, "_cache", {})
+    return Orders()
+
+
+def test_decrease_inventory_batch_payload(orders, monkeypatch):
+    sent = []
+
+    def post(endpoint, headers=None, data=None, timeout=None):
+        sent.append((endpoint, json.loads(data), timeout))
+        response = requests.Response()
+        response.status_code = 200
+        response._content = b"{}"
+        return response
+
+    monkeypatch.setattr(wix_api.requests, "post", post)
+    Inventory().decrease_inventory_batch([("p1", "v1", 3), ("p2", None, 1)])
+    endpoint, data, timeout = sent[0]
+    assert endpoint.endswith("inventoryItems/decrement")
+    assert data == {
+        "decrementData": [
+            {"productId": "p1", "variantId": "v1", "decrementBy": 3},
+            {
+                "productId": "p2",
+                "variantId": "00000000-0000-0000-0000-000000000000",
+                "decrementBy": 1,
+            },
+        ]
+    }
+    assert timeout == WixAPI.timeouts["decrease_inventory"]
+
+
+def test_breaker_opens_after_threshold_and_half_opens_after_cooldown(monkeypatch):
+    now = [0.0]
+    monkeypatch.setattr(wix_api.time, "monotonic", lambda: now[0])
+    breaker = CircuitBreaker(failure_threshold=2, cooldown=10.0)
+    breaker.record_failure()
+    assert breaker.allow_request()
+    breaker.record_failure()
+    assert not breaker.allow_request()
+    now[0] = 10.0
+    # half-open: one trial request, then closed again until it reports back
+    assert breaker.allow_request()
+    assert not breaker.allow_request()
+    breaker.record_failure()
+    assert not breaker.allow_request()
+    now[0] = 20.0
+    assert breaker.allow_request()
+    breaker.record_success()
+    assert breaker.allow_request()
+    assert breaker.failures == 0
+
+
+def test_open_breaker_serves_stale_response_or_fails_fast(orders, monkeypatch):
+    calls = []
+
+    def request(method, endpoint, **kwargs):
+        calls.append(endpoint)
+        if len(calls) > 1:
+            raise requests.ConnectionError("down")
+        return FakeResponse(body={"order": 1})
+
+    monkeypatch.setattr(wix_api.requests, "request", request)
+    assert orders.get_order("1") == {"order": 1}
+    for _ in range(3):
+        assert orders.get_order("1") == {"order": 1}
+    assert not WixAPI._breakers["get_order"].allow_request()
+    n_calls = len(calls)
+    assert orders.get_order("1") == {"order": 1}
+    assert len(calls) == n_calls
+    with pytest.raises(CircuitOpenError):
+        orders._read_request("get_order", "GET", "other", headers={})
+
+
+def test_slow_request_is_hedged(orders, monkeypatch):
+    calls = []
+
+    def request(method, endpoint, **kwargs):
+        calls.append(endpoint)
+        if len(calls) == 1:
+            time.sleep(0.5)
+            return FakeResponse(body={"hedged": False})
+        return FakeResponse(body={"hedged": True})
+
+    monkeypatch.setattr(wix_api.requests, "request", request)
+    monkeypatch.setattr(WixAPI, "hedge_default_delay", 0.05)
+    assert orders.get_order("1") == {"hedged": True}
+    assert len(calls) == 2
+
+
+def test_failed_calls_count_towards_latency(orders, monkeypatch):
+    def request(method, endpoint, **kwargs):
+        raise requests.Timeout("slow")
+
+    monkeypatch.setattr(wix_api.requests, "request", request)
+    monkeypatch.setattr(WixAPI, "hedge_default_delay", 100.0)
+    orders.get_order("1")
+    assert len(WixAPI._latencies["get_order"]) == 1
+
+
+def test_whole_request_deadline_counts_as_failure(orders, monkeypatch):
+    def request(method, endpoint, **kwargs):
+        time.sleep(0.5)
+        return FakeResponse()
+
+    monkeypatch.setattr(wix_api.requests, "request", request)
+    monkeypatch.setattr(WixAPI, "timeouts", {"get_order": 0.1})
+    with pytest.raises(requests.Timeout):
+        orders._read_request("get_order", "GET", "endpoint", headers={})
+    assert WixAPI._breakers["get_order"].failures == 1
+
+
+def test_hedging_stays_on_when_latency_window_is_full_of_timeouts(orders, monkeypatch):
+    calls = []
+
+    def request(method, endpoint, **kwargs):
+        calls.append(endpoint)
+        if len(calls) == 1:
+            time.sleep(0.5)
+            return FakeResponse(body={"hedged": False})
+        return FakeResponse(body={"hedged": True})
+
+    monkeypatch.setattr(wix_api.requests, "request", request)
+    monkeypatch.setattr(WixAPI, "timeouts", {"get_order": 0.2})
+    WixAPI._latencies["get_order"] = [0.2] * WixAPI.latency_window
+    assert orders._hedge_delay("get_order", 0.2) < 0.2
+    assert orders.get_order("1") == {"hedged": True}
+    assert len(calls) == 2
+
+
+def test_rate_limited_response_counts_as_breaker_failure(orders, monkeypatch):
+    def request(method, endpoint, **kwargs):
+        return FakeResponse(status_code=429)
+
+    monkeypatch.setattr(wix_api.requests, "request", request)
+    breaker = WixAPI._breakers.setdefault("get_order", CircuitBreaker())
+    breaker.record_failure()
+    response = orders._read_request("get_order", "GET", "endpoint", headers={})
+    assert response.status_code == 429
+    assert breaker.failures == 2
+    orders._read_request("get_order", "GET", "endpoint", headers={})
+    assert not breaker.allow_request()